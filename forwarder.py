@@ -1,12 +1,169 @@
 #!/usr/bin/env python
 import argparse
+import ctypes
+import ctypes.util
+import errno
+import functools
+import itertools
 import json
 import logging
+import multiprocessing
 import os
+import select
 import socket
+import sys
 import time
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
 
+try:
+    import ijson  # type: ignore
+except ImportError:
+    ijson = None  # type: ignore
+
+
+_O_NOATIME = getattr(os, 'O_NOATIME', 0)
+
+
+def _slurp(path):
+    """
+    Reads a whole file with as few syscalls as possible, without updating its access time where that's supported.
+    """
+    flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+    try:
+        fd = os.open(path, flags | _O_NOATIME)
+    except PermissionError:
+        # O_NOATIME is only permitted on files owned by the current user.
+        if not _O_NOATIME:
+            raise
+        fd = os.open(path, flags)
+    try:
+        size = os.fstat(fd).st_size
+        chunks = []
+        while True:
+            chunk = os.read(fd, max(size, 1 << 16))
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+    finally:
+        os.close(fd)
+
+
+def load_json_file(path):
+    data = _slurp(path)
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
+
+
+# Number of packets handed to the kernel per sendmmsg call.
+SENDMMSG_BATCH_SIZE = 64
+
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        pass
+
+_sendmmsg = getattr(_libc, 'sendmmsg', None)
+_inotify_init1 = getattr(_libc, 'inotify_init1', None)
+_inotify_add_watch = getattr(_libc, 'inotify_add_watch', None)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_IOVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', _MsgHdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+def send_packets(sock, packets):
+    """
+    Sends each packet as a separate datagram to the address the socket is connected to.
+
+    On Linux this uses sendmmsg to send up to SENDMMSG_BATCH_SIZE packets per syscall. Elsewhere it falls back to
+    calling send for each packet.
+
+    A connected UDP socket reports an ICMP port unreachable error from an earlier send as ECONNREFUSED on a later one,
+    and nothing is sent by the call that reports it. So a refused send is retried once before the error is raised.
+    """
+    if _sendmmsg is None:
+        for packet in packets:
+            try:
+                sock.send(packet)
+            except ConnectionRefusedError:
+                sock.send(packet)
+        return
+
+    for offset in range(0, len(packets), SENDMMSG_BATCH_SIZE):
+        batch = packets[offset:offset + SENDMMSG_BATCH_SIZE]
+        iovecs = (_IOVec * len(batch))()
+        msgs = (_MMsgHdr * len(batch))()
+        for i, packet in enumerate(batch):
+            iovecs[i].iov_base = ctypes.cast(ctypes.c_char_p(packet), ctypes.c_void_p)
+            iovecs[i].iov_len = len(packet)
+            hdr = msgs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(iovecs[i])
+            hdr.msg_iovlen = 1
+
+        sent = 0
+        retried = False
+        while sent < len(batch):
+            n = _sendmmsg(sock.fileno(), ctypes.byref(msgs, sent * ctypes.sizeof(_MMsgHdr)), len(batch) - sent, 0)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err == errno.ECONNREFUSED and not retried:
+                    retried = True
+                    continue
+                raise OSError(err, os.strerror(err))
+            sent += n
+
+
+class _MetricNameTable(dict):
+    """
+    A str.translate table that replaces everything but alphanumerics, underscores, and periods with underscores. Entries
+    are filled in as characters are encountered so that non-ASCII characters are handled the same way as ASCII ones.
+    """
+    def __missing__(self, key):
+        c = chr(key)
+        value = c if c.isalnum() or c == '_' or c == '.' else '_'
+        self[key] = value
+        return value
+
+
+_METRIC_NAME_TABLE = _MetricNameTable()
+
+
+@functools.lru_cache(maxsize=4096)
 def normalize_metric_name(name):
     """
     Makes the name conform to common naming conventions and limitations:
@@ -19,81 +176,200 @@ def normalize_metric_name(name):
     if not name[0].isalpha():
         name = 'x' + name
     name = name.lower()
-    name = ''.join(['_' if not c.isalnum() and c != '_' and c != '.' else c for c in name])
+    name = name.translate(_METRIC_NAME_TABLE)
     return name[:200]
 
 
-def statsd_lines_from_samples_data(game_data, samples_data, flavor):
-    lines = []
+class _GaugeValueStrs(dict):
+    """
+    Maps gauge values to their string representations. Values outside of the precomputed range are converted on demand
+    and not stored.
+    """
+    def __missing__(self, key):
+        return str(key)
 
-    for entity in samples_data['entities']:
-        settings = entity['settings']
-        if not settings['name']:
+
+# Most gauge values are small, and with absent signals treated as 0 the vast majority are exactly 0, so the strings for
+# common values are created up front. Lines index this directly rather than going through a function call.
+_GAUGE_VALUE_STRS = _GaugeValueStrs((n, str(n)) for n in range(-1024, 8193))
+
+
+@functools.lru_cache(maxsize=1024)
+def _render_tags(tags):
+    """
+    Converts a combinator's comma-separated "key=value" tag setting into "key:value," dogstatsd tags, ready to be
+    followed by the signal tags.
+    """
+    ret = ''
+    for kv in tags.split(','):
+        if not kv:
             continue
-        name = normalize_metric_name(settings['name'])
+        parts = kv.split('=', 1)
+        if len(parts) > 1:
+            ret += parts[0]+':'+parts[1]+','
+        else:
+            ret += parts[0]+','
+    return ret
+
+
+@functools.lru_cache(maxsize=None)
+def _signal_tags(signal_type, signal_name):
+    """
+    Returns the rendered signal_type and signal_name tags for a signal. There's a fixed set of signals for any given game
+    data, so the same string is shared by every gauge for that signal. The cache should be cleared when the game data is
+    reloaded.
+    """
+    return 'signal_type:' + signal_type + ',signal_name:' + signal_name
+
+
+def _absent_signals_template(game_data):
+    """
+    Returns the signal tags for every signal in the game data. Every treat-as-0 combinator fills in its gauges from this
+    list, so it's built once and stored in the game data itself.
+    """
+    template = game_data.get('_absent_signals_template')
+    if template is None:
+        template = []
+        for signal_type, signal_names in [
+            ('virtual', game_data['virtual_signal_names']),
+            ('item', game_data['item_names']),
+            ('fluid', game_data['fluid_names']),
+        ]:
+            for signal_name in signal_names:
+                template.append(_signal_tags(signal_type, signal_name))
+        game_data['_absent_signals_template'] = template
+    return template
+
+
+def _statsd_lines_from_entity(game_data, entity, flavor):
+    settings = entity['settings']
+    if not settings['name']:
+        return []
+    name = normalize_metric_name(settings['name'])
+
+    # Maps each signal's tags to its count. The tags identify the signal, so no other per-gauge state is needed. They
+    # also make better keys than (type, name) tuples: the strings come from _signal_tags' cache and hash only once, where
+    # a tuple's hash is recomputed on every lookup.
+    if settings['absent_signals'] == 'treat-as-0':
+        gauges = dict.fromkeys(_absent_signals_template(game_data), 0)
+    else:
         gauges = {}
 
-        tags = []
-        for kv in settings['tags'].split(','):
-            parts = kv.split('=', 1)
-            if len(parts) > 1:
-                tags.append(parts[0]+':'+parts[1])
-            else:
-                tags.append(parts[0])
-
-        for signals in [entity.get('red_signals', []), entity.get('green_signals', [])]:
-            for signal in signals:
-                signal_type_name = signal['signal']['type'] + '.' + signal['signal']['name']
-                key = name + '|' + signal_type_name
-                gauge = gauges.get(key, None)
-                if gauge is None:
-                    gauges[key] = {
-                        'name': name,
-                        'n': signal['count'],
-                        'tags': tags + ['signal_type:' + signal['signal']['type'], 'signal_name:' + signal['signal']['name']],
-                    }
-                else:
-                    gauge['n'] += signal['count']
-
-        if settings['absent_signals'] == 'treat-as-0':
-            for signal_type, signal_names in [
-                ('virtual', game_data['virtual_signal_names']),
-                ('item', game_data['item_names']),
-                ('fluid', game_data['fluid_names']),
-            ]:
-                for signal_name in signal_names:
-                    signal_type_name = signal_type + '.' + signal_name
-                    key = name + '|' + signal_type_name
-                    if key not in gauges:
-                        gauges[key] = {
-                            'name': name,
-                            'n': 0,
-                            'tags': tags + ['signal_type:' + signal_type, 'signal_name:' + signal_name],
-                        }
-
-        if flavor == 'dogstatsd' and tags:
-            lines.extend([name + ':' + str(g['n']) + '|g|#' + ','.join(g['tags']) for g in gauges.values()])
-        else:
-            lines.extend([name + ':' + str(g['n']) + '|g' for g in gauges.values()])
+    for signals in [entity.get('red_signals', []), entity.get('green_signals', [])]:
+        for signal in signals:
+            signal_tags = _signal_tags(signal['signal']['type'], signal['signal']['name'])
+            gauges[signal_tags] = gauges.get(signal_tags, 0) + signal['count']
+
+    # Each line is built by a single f-string, which CPython compiles to one string join.
+    values = _GAUGE_VALUE_STRS
+    if flavor == 'dogstatsd':
+        tags = _render_tags(settings['tags'])
+        return [f'{name}:{values[n]}|g|#{tags}{signal_tags}' for signal_tags, n in gauges.items()]
+    return [f'{name}:{values[n]}|g' for n in gauges.values()]
+
 
+def statsd_lines_from_samples_data(game_data, samples_data, flavor):
+    lines = []
+    for entity in samples_data['entities']:
+        lines.extend(_statsd_lines_from_entity(game_data, entity, flavor))
     return lines
 
 
 def statsd_packets_from_lines(lines, max_size):
-    buf = ''
+    # Each packet's lines are collected and joined once, so every packet is a single allocation of exactly the right size.
     ret = []
+    packet_lines = []
+    packet_size = -1
     for line in lines:
-        if len(buf) + 1 + len(line) > max_size:
-            ret.append(buf.encode('utf-8'))
-            buf = ''
-        if buf:
-            buf += '\n'
-        buf += line
-    if buf:
-        ret.append(buf.encode('utf-8'))
+        # Formatting lines as str with f-strings and encoding them here is faster than building them as bytes, which needs
+        # a concatenation per piece. Leaving out the codec name skips its lookup; UTF-8 is the default.
+        line = line.encode()
+        if packet_lines and packet_size + 1 + len(line) > max_size:
+            ret.append(b'\n'.join(packet_lines))
+            packet_lines = []
+            packet_size = -1
+        packet_lines.append(line)
+        packet_size += 1 + len(line)
+    if packet_lines:
+        ret.append(b'\n'.join(packet_lines))
     return ret
 
 
+# Number of entities handed to a worker process at a time.
+WORKER_CHUNK_SIZE = 64
+
+_worker_game_data = None
+_worker_flavor = None
+
+
+def _init_worker(game_data, flavor):
+    global _worker_game_data, _worker_flavor
+    _worker_game_data = game_data
+    _worker_flavor = flavor
+
+
+def _worker_statsd_lines_from_entity(entity):
+    return _statsd_lines_from_entity(_worker_game_data, entity, _worker_flavor)
+
+
+def create_worker_pool(processes, game_data, flavor):
+    """
+    Creates a process pool that statsd_packets_from_entities can use to format entities in parallel. The game data is
+    sent to each worker once, so a new pool must be created whenever it changes.
+    """
+    return multiprocessing.Pool(processes, initializer=_init_worker, initargs=(game_data, flavor))
+
+
+def statsd_packets_from_entities(game_data, entities, flavor, max_size, pool=None):
+    """
+    Formats and packs the gauges for any iterable of sampled entities in a single pass. Each entity's lines are packed
+    as soon as they're formatted, so neither the full list of lines nor the full list of entities is ever needed.
+
+    If a pool from create_worker_pool is given, entities are formatted by its workers using the game data and flavor it
+    was created with. In that case the entities are collected into a list first, because the pool would otherwise read
+    them from a background thread that can outlive this call (and the file a streamed iterable is reading from).
+    """
+    if pool is not None:
+        entities = list(entities)
+        entity_lines = pool.imap(_worker_statsd_lines_from_entity, entities, WORKER_CHUNK_SIZE)
+    else:
+        entity_lines = (_statsd_lines_from_entity(game_data, entity, flavor) for entity in entities)
+    return statsd_packets_from_lines(itertools.chain.from_iterable(entity_lines), max_size)
+
+
+def watch_directory(path):
+    """
+    Returns an inotify file descriptor that becomes readable whenever a file in the directory is closed after writing
+    or moved into it. Returns None if inotify isn't available or the directory can't be watched.
+    """
+    if _inotify_init1 is None:
+        return None
+    fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if _inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def wait_for_directory_change(watch_fd, timeout):
+    """
+    Blocks until the directory watched by watch_fd changes or the timeout elapses. If watch_fd is None, this simply
+    sleeps for the timeout.
+    """
+    if watch_fd is None:
+        time.sleep(timeout)
+        return
+    readable, _, _ = select.select([watch_fd], [], [], timeout)
+    if readable:
+        try:
+            while os.read(watch_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
 if __name__ == '__main__':
     default_script_output = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'script-output')
 
@@ -102,8 +378,13 @@ if __name__ == '__main__':
     parser.add_argument('--statsd-flavor', type=str, choices=['vanilla', 'dogstatsd'], default='vanilla', help='the flavor of statsd to use (note that vanilla statsd does not currently support tags)')
     parser.add_argument('--statsd-port', type=int, default=8125, help='the port that statsd is listening on (default: 8125)')
     parser.add_argument('--statsd-host', type=str, default='127.0.0.1', help='the host where statsd is listening (default: 127.0.0.1)')
+    parser.add_argument('--stream-samples', action='store_true', help='parse samples incrementally with ijson to reduce memory usage at the cost of speed (requires ijson)')
+    parser.add_argument('--workers', type=int, default=1, help='the number of processes to format metrics with. only worth raising for very large factories (default: 1)')
     args = parser.parse_args()
 
+    if args.stream_samples and ijson is None:
+        parser.error('--stream-samples requires ijson to be installed')
+
     logging.basicConfig(level=logging.INFO)
 
     if not os.path.exists(os.path.dirname(args.factorio_script_output)):
@@ -114,38 +395,62 @@ if __name__ == '__main__':
     data_path = os.path.join(args.factorio_script_output, 'factorystatsd-game-data.json')
     samples_path = os.path.join(args.factorio_script_output, 'factorystatsd-samples.json')
 
-    last_game_data_mod_time = 0
+    last_game_data_mod_time = 0.0
     game_data = None
+    pool = None
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+    sock_connected = False
+    watch_fd = None
 
     while True:
         try:
+            if watch_fd is None:
+                watch_fd = watch_directory(args.factorio_script_output)
+
+            if not sock_connected:
+                # The destination never changes, so connecting lets the kernel resolve the route once rather than on every
+                # send. This is retried until it succeeds since the host may not be resolvable yet.
+                sock.connect((args.statsd_host, args.statsd_port))
+                sock_connected = True
+
             if not os.path.exists(data_path):
-                time.sleep(1.0)
+                wait_for_directory_change(watch_fd, 1.0)
                 continue
 
             game_data_mod_time = os.path.getmtime(data_path)
             if game_data is None or game_data_mod_time > last_game_data_mod_time:
-                with open(data_path) as f:
-                    game_data = json.load(f)
+                game_data = load_json_file(data_path)
+                _signal_tags.cache_clear()
+                if args.workers > 1:
+                    if pool is not None:
+                        pool.terminate()
+                        pool.join()
+                    pool = create_worker_pool(args.workers, game_data, args.statsd_flavor)
                 logging.info('loaded game data')
             last_game_data_mod_time = game_data_mod_time
 
             if not os.path.exists(samples_path):
-                time.sleep(0.1)
+                wait_for_directory_change(watch_fd, 0.1 if watch_fd is None else 1.0)
                 continue
 
-            with open(samples_path) as f:
-                samples = json.load(f)
+            if args.stream_samples:
+                # Stream the entities rather than loading the whole file, which can be large for big factories.
+                with open(samples_path, 'rb') as f:
+                    packets = statsd_packets_from_entities(game_data, ijson.items(f, 'entities.item'), args.statsd_flavor, 1432, pool)
+            else:
+                samples = load_json_file(samples_path)
+                packets = statsd_packets_from_entities(game_data, samples['entities'], args.statsd_flavor, 1432, pool)
             os.unlink(samples_path)
 
-            statsd_lines = statsd_lines_from_samples_data(game_data, samples, args.statsd_flavor)
-            packets = statsd_packets_from_lines(statsd_lines, 1432)
             if packets:
-                for packet in packets:
-                    sock.sendto(packet, (args.statsd_host, args.statsd_port))
+                send_packets(sock, packets)
                 logging.info('sent {} packets to statsd'.format(len(packets)))
+        except ConnectionRefusedError:
+            # Connected UDP sockets report ICMP port unreachable errors from earlier sends. This just means statsd
+            # isn't listening right now.
+            logging.warning('statsd is not accepting packets at {}:{}'.format(args.statsd_host, args.statsd_port))
         except Exception:
             logging.exception('forwarder exception')
             time.sleep(1.0)
@@ -1,9 +1,37 @@
 #!/usr/bin/env python
+import os
+import socket
+import tempfile
+import time
 import unittest
-from forwarder import statsd_lines_from_samples_data, statsd_packets_from_lines
+from forwarder import (
+    create_worker_pool,
+    load_json_file,
+    normalize_metric_name,
+    send_packets,
+    statsd_lines_from_samples_data,
+    statsd_packets_from_entities,
+    statsd_packets_from_lines,
+    wait_for_directory_change,
+    watch_directory,
+)
 
 
 class TestForwarder(unittest.TestCase):
+    def test_load_json_file(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'factorystatsd-game-data.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('{"item_names": ["coal", "%s"]}' % ('x' * 100000))
+            self.assertEqual(load_json_file(path), {'item_names': ['coal', 'x' * 100000]})
+
+    def test_normalize_metric_name(self):
+        self.assertEqual(normalize_metric_name('my_metric'), 'my_metric')
+        self.assertEqual(normalize_metric_name('Iron Plates/min'), 'iron_plates_min')
+        self.assertEqual(normalize_metric_name('1st.base'), 'x1st.base')
+        self.assertEqual(normalize_metric_name('Eisenplatten→Ölraffinerie'), 'eisenplatten_ölraffinerie')
+        self.assertEqual(normalize_metric_name('a' * 300), 'a' * 200)
+
     def test_statsd_lines_from_samples_data(self):
         lines = statsd_lines_from_samples_data({}, {
             'entities': {},
@@ -51,10 +79,112 @@ class TestForwarder(unittest.TestCase):
             'my_metric:0|g|#base:alpha,planet:nauvis,ores,signal_type:fluid,signal_name:water',
         ])
 
+        test_samples['entities'][0]['settings']['tags'] = ''
+        test_samples['entities'][0]['settings']['absent_signals'] = 'ignore'
+        lines = statsd_lines_from_samples_data(game_data, test_samples, 'dogstatsd')
+        self.assertEqual(lines, [
+            'my_metric:2|g|#signal_type:item,signal_name:coal',
+        ])
+
     def test_statsd_packets_from_lines(self):
         packets = statsd_packets_from_lines(['foo', 'bar', 'baz'], 7)
         self.assertEqual(packets, [b'foo\nbar', b'baz'])
 
+        packets = statsd_packets_from_lines(['foo', 'barbazqux', 'ö'], 7)
+        self.assertEqual(packets, [b'foo', b'barbazqux', 'ö'.encode('utf-8')])
+
+    def test_statsd_packets_from_entities(self):
+        entities = [{
+            'settings': {
+                'name': name,
+                'tags': '',
+                'absent_signals': 'ignore',
+            },
+            'red_signals': [{
+                'signal': {
+                    'type': 'item',
+                    'name': 'coal',
+                },
+                'count': 2,
+            }],
+        } for name in ['foo', '', 'bar', 'baz']]
+
+        packets = statsd_packets_from_entities({}, iter(entities), 'statsd', 23)
+        self.assertEqual(packets, [b'foo:2|g\nbar:2|g\nbaz:2|g'])
+
+        packets = statsd_packets_from_entities({}, iter(entities), 'statsd', 15)
+        self.assertEqual(packets, [b'foo:2|g\nbar:2|g', b'baz:2|g'])
+
+    def test_statsd_packets_from_entities_with_pool(self):
+        game_data = {
+            'virtual_signal_names': ['signal-A'],
+            'item_names': ['coal', 'iron-ore'],
+            'fluid_names': ['water'],
+        }
+        entities = [{
+            'settings': {
+                'name': 'metric{}'.format(i),
+                'tags': 'base=alpha',
+                'absent_signals': 'treat-as-0' if i % 2 else 'ignore',
+            },
+            'red_signals': [{
+                'signal': {
+                    'type': 'item',
+                    'name': 'coal',
+                },
+                'count': i,
+            }],
+        } for i in range(200)]
+
+        pool = create_worker_pool(2, game_data, 'dogstatsd')
+        self.addCleanup(pool.join)
+        self.addCleanup(pool.terminate)
+        self.assertEqual(
+            statsd_packets_from_entities(game_data, iter(entities), 'dogstatsd', 100, pool),
+            statsd_packets_from_entities(game_data, iter(entities), 'dogstatsd', 100),
+        )
+
+    def test_send_packets(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(receiver.close)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5.0)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+        sender.connect(receiver.getsockname())
+
+        packets = ['packet{}'.format(i).encode('utf-8') for i in range(100)]
+        send_packets(sender, packets)
+        self.assertEqual([receiver.recv(1432) for _ in packets], packets)
+
+    def test_send_packets_after_refusal(self):
+        closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        closed.bind(('127.0.0.1', 0))
+        address = closed.getsockname()
+        closed.close()
+
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+        sender.connect(address)
+        sender.send(b'foo')
+        time.sleep(0.1)
+
+        # The refusal for the first send is reported here, and the send is retried instead of raising.
+        send_packets(sender, [b'bar'])
+
+    def test_wait_for_directory_change(self):
+        with tempfile.TemporaryDirectory() as path:
+            watch_fd = watch_directory(path)
+            if watch_fd is None:
+                self.skipTest('inotify is not available')
+            self.addCleanup(os.close, watch_fd)
+
+            with open(os.path.join(path, 'factorystatsd-samples.json'), 'w') as f:
+                f.write('{}')
+            start = time.monotonic()
+            wait_for_directory_change(watch_fd, 5.0)
+            self.assertLess(time.monotonic() - start, 1.0)
+
 
 if __name__ == '__main__':
     unittest.main()